@@ -2,6 +2,7 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import io
+import re
 from datetime import datetime
 
 # Set page config
@@ -40,6 +41,52 @@ st.markdown("""
 SKU_ALIASES = ['Variant SKU', 'model']
 PRICE_ALIASES = ['Variant Price', 'price']
 
+# Stray latin1/UTF-8 mojibake characters stripped from the final output
+MOJIBAKE_PATTERN = re.compile('[‚ƒÃÂ]')
+
+# Deletion tables for cleaning reference columns in a single pass
+SPACE_TABLE = str.maketrans('', '', ' ')
+NUMERIC_TABLE = str.maketrans('', '', ',- ')
+
+# Missing-value markers pandas' readers recognise by default; polars only
+# treats the empty string as null, so it needs the full list explicitly
+CSV_NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan',
+                 '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None',
+                 'n/a', 'nan', 'null']
+
+# Optional polars acceleration for CSV parsing on large exports
+try:
+    import polars as pl
+except ImportError:
+    pl = None
+
+# Optional numba acceleration for the multiplier lookup on large references
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+if njit is not None:
+    @njit(cache=True, parallel=True)
+    def _lookup_kernel(vals, metal_code, gmk, gmu, smk, smu, pmk, pmu):
+        n = vals.shape[0]
+        out = np.empty(n)
+        for i in prange(n):
+            v = vals[i]
+            code = metal_code[i]
+            if code == 1:
+                k = min(np.searchsorted(smk, v, side='right'), smu.shape[0] - 1)
+                out[i] = smu[k]
+            elif code == 2:
+                k = min(np.searchsorted(pmk, v, side='right'), pmu.shape[0] - 1)
+                out[i] = pmu[k]
+            else:
+                k = min(np.searchsorted(gmk, v, side='right'), gmu.shape[0] - 1)
+                out[i] = gmu[k]
+        return out
+else:
+    _lookup_kernel = None
+
 def detect_column(df, aliases):
     """Return the first alias found in df.columns, or None."""
     for alias in aliases:
@@ -47,96 +94,145 @@ def detect_column(df, aliases):
             return alias
     return None
 
+@st.cache_data
+def load_csv(file_bytes: bytes) -> pd.DataFrame:
+    """Parse uploaded CSV bytes once per unique content, cached across reruns.
+
+    Uses polars' multi-threaded Rust reader when available, converting back
+    to pandas at the boundary; otherwise falls back to the pyarrow engine.
+    """
+    if pl is not None:
+        # polars only reads utf8, so transcode the latin1 bytes once
+        utf8_bytes = file_bytes.decode('latin1').encode('utf-8')
+        try:
+            return pl.read_csv(
+                io.BytesIO(utf8_bytes),
+                infer_schema_length=None,
+                null_values=CSV_NA_VALUES,
+            ).to_pandas()
+        except pl.exceptions.ComputeError:
+            # Anything polars cannot parse goes to the pyarrow engine instead
+            # of surfacing as a processing error
+            pass
+    return pd.read_csv(io.BytesIO(file_bytes), engine='pyarrow', encoding='latin1')
+
+_GOLD_MULT = np.array([2.1, 1.7, 1.5, 1.35, 1.25, 1.175, 1.1, 1.0683, 1], dtype=np.float64)
+_GOLD_FACT = np.array([2, 1.8, 1.6, 1.4, 1.3, 1.2, 1.1, 1.05, 1], dtype=np.float64)
+_SILVER_MULT = np.array([2.2, 1.5573, 1.4615, 1.3571, 1.3073, 1.2025, 1.1176, 1.0555, 1], dtype=np.float64)
+_SILVER_FACT = np.array([2, 1.6, 1.5, 1.4, 1.3, 1.2, 1.1, 1.05, 1], dtype=np.float64)
+
+@st.cache_data
 def gold_table(gold_market: float) -> pd.DataFrame:
-    multipliers = [2.1, 1.7, 1.5, 1.35, 1.25, 1.175, 1.1, 1.0683, 1]
-    factors = [2, 1.8, 1.6, 1.4, 1.3, 1.2, 1.1, 1.05, 1]
-    results = [gold_market / m for m in multipliers]
-    return pd.DataFrame({"Gold Market": results, "Multiplier": factors})
+    return pd.DataFrame({"Gold Market": gold_market / _GOLD_MULT, "Multiplier": _GOLD_FACT})
 
+@st.cache_data
 def silver_table(silver_market: float) -> pd.DataFrame:
-    multipliers_s = [2.2, 1.5573, 1.4615, 1.3571, 1.3073, 1.2025, 1.1176, 1.0555, 1]
-    factors_s = [2, 1.6, 1.5, 1.4, 1.3, 1.2, 1.1, 1.05, 1]
-    results_s = [silver_market / m for m in multipliers_s]
-    return pd.DataFrame({"Gold Market": results_s, "Multiplier": factors_s})
+    return pd.DataFrame({"Gold Market": silver_market / _SILVER_MULT, "Multiplier": _SILVER_FACT})
 
+@st.cache_data
 def platinum_table(platinum_market: float) -> pd.DataFrame:
-    multipliers_p = [2.2, 1.5573, 1.4615, 1.3571, 1.3073, 1.2025, 1.1176, 1.0555, 1]
-    factors_p = [2, 1.6, 1.5, 1.4, 1.3, 1.2, 1.1, 1.05, 1]
-    results_p = [platinum_market / m for m in multipliers_p]
-    return pd.DataFrame({"Gold Market": results_p, "Multiplier": factors_p})
+    # Platinum uses the same multiplier ladder as silver.
+    return pd.DataFrame({"Gold Market": platinum_market / _SILVER_MULT, "Multiplier": _SILVER_FACT})
 
 
 def lookup_multiplier(reference, gold_factor, silver_factor, platinum_factor):
-    gold_factor_sorted = gold_factor.sort_values('Gold Market').reset_index(drop=True)
-    silver_factor_sorted = silver_factor.sort_values('Gold Market').reset_index(drop=True)
-    platinum_factor_sorted = platinum_factor.sort_values('Gold Market').reset_index(drop=True)
-
-    def find_multiplier_above(value, factor_df, market_col='Gold Market'):
-        if pd.isna(value):
-            return pd.NA
-        valid_matches = factor_df[factor_df[market_col] > value]
-        if valid_matches.empty:
-            return factor_df.iloc[-1]['Multiplier']
-        else:
-            return valid_matches.iloc[0]['Multiplier']
-
-    def lookup_multiplier_by_metal(row):
-        market_value = row['Gold Market']
-        metal_type = row['Metal']
-        if pd.isna(market_value) or pd.isna(metal_type):
-            return pd.NA
-        if metal_type == 'S/S':
-            return find_multiplier_above(market_value, silver_factor_sorted)
-        elif metal_type == 'PLATINUM':
-            return find_multiplier_above(market_value, platinum_factor_sorted)
-        else:
-            return find_multiplier_above(market_value, gold_factor_sorted)
-
-    reference['Multiplier'] = reference.apply(lookup_multiplier_by_metal, axis=1)
+    def sorted_arrays(factor_df):
+        factor_sorted = factor_df.sort_values('Gold Market')
+        return factor_sorted['Gold Market'].to_numpy(), factor_sorted['Multiplier'].to_numpy()
+
+    gold_markets, gold_mults = sorted_arrays(gold_factor)
+    silver_markets, silver_mults = sorted_arrays(silver_factor)
+    platinum_markets, platinum_mults = sorted_arrays(platinum_factor)
+
+    values = reference['Gold Market'].to_numpy(dtype=np.float64)
+    metal = reference['Metal']
+
+    # Computed once and reused below; comparing the Series keeps categorical
+    # Metal on its int8 codes instead of materializing an object array.
+    is_silver = (metal == 'S/S').to_numpy()
+    is_platinum = (metal == 'PLATINUM').to_numpy()
+
+    if _lookup_kernel is not None:
+        # Fused single-pass kernel: one branchy loop, no temporary arrays.
+        metal_code = np.zeros(len(values), dtype=np.int8)
+        metal_code[is_silver] = 1
+        metal_code[is_platinum] = 2
+        out = _lookup_kernel(
+            values, metal_code,
+            gold_markets, gold_mults,
+            silver_markets, silver_mults,
+            platinum_markets, platinum_mults,
+        )
+    else:
+        def multipliers_above(markets, mults):
+            # First factor row strictly above the market value, or the last row
+            # when the value is above the whole table (same fallback as before).
+            idx = np.searchsorted(markets, values, side='right')
+            return mults[np.minimum(idx, len(markets) - 1)]
+
+        out = np.where(
+            is_silver, multipliers_above(silver_markets, silver_mults),
+            np.where(is_platinum, multipliers_above(platinum_markets, platinum_mults),
+                     multipliers_above(gold_markets, gold_mults))
+        )
+    # Single upfront mask instead of per-row pd.isna checks; NaN keeps the
+    # column float64 rather than upcasting to object via pd.NA.
+    out[np.isnan(values) | metal.isna().to_numpy()] = np.nan
+    reference['Multiplier'] = out
     return reference
 
 def update_variant_price_fixed(upload, reference, sku_col, price_col):
-    """Update prices based on reference data, using detected column names."""
-    result = upload.copy()
+    """Update prices based on reference data, using detected column names.
+
+    The upload frame is modified in place; only the two reference columns
+    the join needs are copied.
+    """
+    result = upload
 
     result[sku_col] = result[sku_col].astype(str).str.strip()
-    ref_clean = reference.copy()
+    ref_clean = reference[['Stock ID', 'New Price']].copy()
     ref_clean['Stock ID'] = ref_clean['Stock ID'].astype(str).str.strip()
 
     result.loc[result[sku_col] == 'nan', sku_col] = ''
-    ref_clean.loc[ref_clean['Stock ID'] == 'nan', 'Stock ID'] = ''
-
-    price_lookup = {}
-    for idx, row in ref_clean.iterrows():
-        stock_id = row['Stock ID']
-        new_price = row['New Price']
-        if (stock_id != '' and not pd.isna(stock_id) and
-                not pd.isna(new_price) and str(stock_id) != 'nan'):
-            price_lookup[stock_id] = new_price
-
-    successful_updates = 0
-    skipped_blank_sku = 0
-    skipped_no_match = 0
-
-    for idx in result.index:
-        variant_sku = result.loc[idx, sku_col]
-        if variant_sku == '' or pd.isna(variant_sku):
-            skipped_blank_sku += 1
-            continue
-        if variant_sku in price_lookup:
-            new_price = price_lookup[variant_sku]
-            if not pd.isna(new_price):
-                result.loc[idx, price_col] = new_price
-                successful_updates += 1
-        else:
-            skipped_no_match += 1
+
+    # One vectorized validity mask over the reference: real, non-blank Stock
+    # IDs with a usable price; subsumes the old 'nan'-rewrite pass.
+    ids = ref_clean['Stock ID']
+    valid = ids.notna() & (ids != '') & (ids != 'nan') & ref_clean['New Price'].notna()
+    ref_clean = ref_clean[valid]
+    # One price per Stock ID, last occurrence winning — the m:1 contract a
+    # merge(validate='m:1') would otherwise enforce.
+    ref_clean = ref_clean.drop_duplicates(subset='Stock ID', keep='last')
+
+    # Factorize both key columns together so the join probes int64 codes
+    # instead of hashing strings, then look prices up by array index.
+    sku = result[sku_col]
+    codes, uniques = pd.factorize(pd.concat([ref_clean['Stock ID'], sku], ignore_index=True))
+    ref_codes = codes[:len(ref_clean)]
+    sku_codes = codes[len(ref_clean):]
+
+    prices = np.full(len(uniques), np.nan)
+    prices[ref_codes] = ref_clean['New Price'].to_numpy(dtype=np.float64)
+    mapped = prices[sku_codes]
+
+    sku_vals = sku.to_numpy()
+    blank_mask = (sku_vals == '') | pd.isna(sku_vals)
+    # code -1 marks SKUs absent from the factorization (missing values)
+    match_mask = (sku_codes >= 0) & ~np.isnan(mapped) & ~blank_mask
+    result[price_col] = np.where(
+        match_mask, mapped, pd.to_numeric(result[price_col], errors='coerce').to_numpy(dtype=np.float64)
+    )
+
+    successful_updates = int(match_mask.sum())
+    skipped_blank_sku = int(blank_mask.sum())
+    skipped_no_match = len(result) - successful_updates - skipped_blank_sku
 
     return result, successful_updates, skipped_blank_sku, skipped_no_match
 
 def process_precious_metals_data(reference_file, upload_file, gold_price, silver_price, platinum_price):
     try:
-        reference = pd.read_csv(reference_file, encoding='latin1')
-        upload = pd.read_csv(upload_file, encoding='latin1')
+        reference = load_csv(reference_file.getvalue())
+        upload = load_csv(upload_file.getvalue())
 
         # Detect SKU and Price columns
         sku_col = detect_column(upload, SKU_ALIASES)
@@ -151,42 +247,60 @@ def process_precious_metals_data(reference_file, upload_file, gold_price, silver
 
         st.info(f"Detected columns → SKU: **{sku_col}** | Price: **{price_col}**")
 
-        # Process reference data
-        reference["Date Created"] = pd.to_datetime(reference["Date Created"], errors="coerce")
-        reference["Date Last Price Change"] = pd.to_datetime(reference["Date Last Price Change"], errors="coerce")
-        reference["Last Stocked"] = pd.to_datetime(reference["Last Stocked"], errors="coerce")
-
-        reference["Max Date"] = reference[
-            ["Date Created", "Date Last Price Change", "Last Stocked"]
-        ].max(axis=1)
-
-        reference = reference.sort_values(by="Max Date", ascending=False).reset_index(drop=True)
+        # Narrow the reference before any heavy pass: everything below only
+        # moves fewer bytes once the unused columns are gone
+        unused_columns = ["Bar Code ID", "Department", "Description", "Qty On Hand",
+                          "Type", "Vendor Name", "UID", "Vendor UID", "Photo"]
+        reference = reference.drop(columns=[col for col in unused_columns if col in reference.columns])
+
+        # Parse all three date columns in one call, trying the fast ISO8601
+        # C parser before the flexible fallback
+        date_cols = ["Date Created", "Date Last Price Change", "Last Stocked"]
+        stacked = reference[date_cols].stack()
+        parsed = pd.to_datetime(stacked, format="ISO8601", errors="coerce")
+        failed = parsed.isna() & stacked.notna()
+        if failed.any():
+            # Re-parse only the values the ISO parser rejected, so mixed
+            # ISO / US-format dates all survive instead of coercing to NaT
+            parsed[failed] = pd.to_datetime(stacked[failed], errors="coerce")
+        # reindex + astype guard the empty/all-blank case, where unstack
+        # yields fewer columns than date_cols (raising on assignment) and the
+        # refilled columns would otherwise come back non-datetime
+        reference[date_cols] = (
+            parsed.unstack().reindex(columns=date_cols).astype('datetime64[ns]')
+        )
 
-        columns_to_drop = ["Date Created", "Date Last Price Change", "Last Stocked",
-                           "Bar Code ID", "Department", "Description", "Qty On Hand",
-                           "Type", "Vendor Name", "UID", "Vendor UID", "Photo"]
-        columns_to_drop = [col for col in columns_to_drop if col in reference.columns]
-        reference = reference.drop(columns=columns_to_drop)
+        reference["Max Date"] = reference[date_cols].max(axis=1)
+        reference = reference.drop(columns=date_cols)
 
         today = pd.Timestamp.today().normalize()
-        reference = reference[reference["Max Date"] <= today].reset_index(drop=True)
+        reference = reference[reference["Max Date"] <= today]
 
-        reference["Stock ID"] = reference["Stock ID"].fillna("").astype(str).str.replace(" ", "", regex=False)
-        reference["Metal"] = reference["Metal"].fillna("").astype(str).str.replace(" ", "", regex=False)
+        reference["Stock ID"] = reference["Stock ID"].fillna("").astype(str).str.translate(SPACE_TABLE)
+        reference["Metal"] = reference["Metal"].fillna("").astype(str).str.translate(SPACE_TABLE)
         reference["Metal"] = reference["Metal"].str.replace("SS", "S/S", regex=False)
-        reference = reference.drop_duplicates(subset=["Stock ID"]).reset_index(drop=True)
+        # Keep the latest row per Stock ID: O(N) group-max instead of sorting
+        # the whole frame just to dedupe on first occurrence.
+        reference = reference.loc[
+            reference.groupby("Stock ID", sort=False)["Max Date"].idxmax()
+        ].reset_index(drop=True)
 
         if "Gold Market" in reference.columns:
-            reference["Gold Market"] = reference["Gold Market"].fillna("")
-            reference["Gold Market"] = reference["Gold Market"].astype(str).str.replace(",", "", regex=False)
-            reference["Gold Market"] = reference["Gold Market"].str.replace("-", "", regex=False)
-            reference["Gold Market"] = reference["Gold Market"].str.replace(" ", "", regex=False)
-            reference["Gold Market"] = pd.to_numeric(reference["Gold Market"], errors="coerce")
+            reference["Gold Market"] = pd.to_numeric(
+                reference["Gold Market"].fillna("").astype(str).str.translate(NUMERIC_TABLE),
+                errors="coerce",
+            )
 
         if "Price Per Unit" in reference.columns:
             reference["Price Per Unit"] = pd.to_numeric(reference["Price Per Unit"], errors="coerce")
             reference["Price Per Unit"] = reference["Price Per Unit"].fillna(0)
 
+        # Shrink to the smallest safe representation before the heavy passes
+        for col in ("Price Per Unit", "Gold Market"):
+            if col in reference.columns:
+                reference[col] = pd.to_numeric(reference[col], downcast="float")
+        reference["Metal"] = reference["Metal"].astype("category")
+
         gold_factor = gold_table(gold_price)
         silver_factor = silver_table(silver_price)
         platinum_factor = platinum_table(platinum_price)
@@ -194,14 +308,19 @@ def process_precious_metals_data(reference_file, upload_file, gold_price, silver
         reference = lookup_multiplier(reference, gold_factor, silver_factor, platinum_factor)
 
         reference['Multiplier'] = pd.to_numeric(reference['Multiplier'], errors='coerce').fillna(1.0)
-        reference['New Price'] = reference['Price Per Unit'] * reference['Multiplier']
-        reference['New Price'] = reference['New Price'].round(2)
+
+        # One float32 buffer, multiplied and rounded in place (copy=True so we
+        # never scribble over the Price Per Unit column's own backing array)
+        new_price = reference['Price Per Unit'].to_numpy(dtype=np.float32, copy=True)
+        np.multiply(new_price, reference['Multiplier'].to_numpy(dtype=np.float32), out=new_price)
+        np.round(new_price, 2, out=new_price)
+        reference['New Price'] = new_price
 
         # Ensure price column exists and is numeric
         if price_col not in upload.columns:
             upload[price_col] = 0.0
         else:
-            upload[price_col] = pd.to_numeric(upload[price_col], errors="coerce")
+            upload[price_col] = pd.to_numeric(upload[price_col], errors="coerce", downcast="float")
 
         # Ensure SKU column exists
         if sku_col not in upload.columns:
@@ -214,18 +333,10 @@ def process_precious_metals_data(reference_file, upload_file, gold_price, silver
         upload_updated[price_col] = pd.to_numeric(upload_updated[price_col], errors='coerce')
         upload_updated[price_col] = upload_updated[price_col].round(2)
 
-        for col in upload_updated.columns:
-            if upload_updated[col].dtype == 'object':
-                upload_updated[col] = upload_updated[col].apply(
-                    lambda x: str(x).replace('‚', '').replace('ƒ', '').replace('Ã', '').replace('Â', '').replace('Ã‚', '') if pd.notna(x) else x
-                )
-
-        if 'Body (HTML)' in upload_updated.columns:
-            upload_updated['Body (HTML)'] = upload_updated['Body (HTML)'].str.replace('‚', '', regex=False)
-            upload_updated['Body (HTML)'] = upload_updated['Body (HTML)'].str.replace('ƒ', '', regex=False)
-            upload_updated['Body (HTML)'] = upload_updated['Body (HTML)'].str.replace('Ã', '', regex=False)
-            upload_updated['Body (HTML)'] = upload_updated['Body (HTML)'].str.replace('Â', '', regex=False)
-            upload_updated['Body (HTML)'] = upload_updated['Body (HTML)'].str.replace('Ã‚', '', regex=False)
+        for col in upload_updated.select_dtypes(include='object').columns:
+            upload_updated[col] = upload_updated[col].astype('string').str.replace(
+                MOJIBAKE_PATTERN, '', regex=True
+            )
 
         return upload_updated, {
             'successful_updates': successful_updates,
@@ -314,18 +425,18 @@ def main():
 
                     st.subheader("📥 Download Results")
 
-                    csv_buffer = io.StringIO()
-                    result_df.to_csv(csv_buffer, index=False)
+                    csv_buffer = io.BytesIO()
+                    result_df.to_csv(csv_buffer, index=False, compression='gzip')
                     csv_data = csv_buffer.getvalue()
 
                     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                    filename = f"processed_precious_metals_{timestamp}.csv"
+                    filename = f"processed_precious_metals_{timestamp}.csv.gz"
 
                     st.download_button(
                         label="📥 Download Processed Data",
                         data=csv_data,
                         file_name=filename,
-                        mime="text/csv",
+                        mime="application/gzip",
                         type="primary",
                         use_container_width=True
                     )